@@ -6,11 +6,6 @@ import os
 import click
 from os.path import join
 from moseq2_model.util import count_frames as count_frames_wrapper
-from moseq2_model.helpers.wrappers import (
-    learn_model_wrapper,
-    kappa_scan_fit_models_wrapper,
-    apply_model_wrapper,
-)
 
 orig_init = click.core.Option.__init__
 
@@ -58,6 +53,12 @@ def modeling_parameters(function):
         default=-1,
         help="Random seed for holding out data (set for reproducibility)",
     )(function)
+    function = click.option(
+        "--seed",
+        type=int,
+        default=None,
+        help="Random seed for the added noise and unseeded hold-out splits (set for reproducibility)",
+    )(function)
     function = click.option(
         "--nfolds", type=int, default=5, help="Number of folds for split"
     )(function)
@@ -158,6 +159,12 @@ def modeling_parameters(function):
     function = click.option(
         "--robust", is_flag=True, help="Use robust AR-HMM model. More tolerant to noise"
     )(function)
+    function = click.option(
+        "--dtype",
+        type=click.Choice(["float32", "float64"]),
+        default="float64",
+        help="Floating point precision of the PC scores used for training. float32 halves memory use",
+    )(function)
     function = click.option(
         "--check-every",
         type=int,
@@ -215,6 +222,8 @@ def modeling_parameters(function):
 )
 def learn_model(input_file, dest_file, **config_data):
     # Train the ARHMM using PC scores located in the INPUT_FILE, and saves the model to DEST_FILE
+    # the modeling stack is slow to import, so only load it for the commands that need it
+    from moseq2_model.helpers.wrappers import learn_model_wrapper
 
     learn_model_wrapper(input_file, dest_file, config_data)
 
@@ -246,6 +255,7 @@ def learn_model(input_file, dest_file, **config_data):
 )
 def apply_model(model_file, pc_file, dest_file, **config_data):
     # Apply the ARHMM located in MODEL_FILE to the PC scores in PC_FILE, and saves the results to DEST_FILE
+    from moseq2_model.helpers.wrappers import apply_model_wrapper
 
     apply_model_wrapper(model_file, pc_file, dest_file, config_data)
 
@@ -306,9 +316,16 @@ def apply_model(model_file, pc_file, dest_file, **config_data):
 )
 @click.option("--get-cmd", is_flag=True, help="Print scan command strings.")
 @click.option("--run-cmd", is_flag=True, help="Run scan command strings.")
+@click.option(
+    "--max-workers",
+    type=int,
+    default=1,
+    help="Number of models to train in parallel with --run-cmd (local only). Each model loads the full PC dataset, so raise this only if there is memory for it.",
+)
 @modeling_parameters
 def kappa_scan_fit_models(input_file, output_dir, **config_data):
     # Scan through the kappa hyperparameter to find the kappa that best matches the changepoint duration distribution.
+    from moseq2_model.helpers.wrappers import kappa_scan_fit_models_wrapper
 
     config_data["out_script"] = join(output_dir, config_data["out_script"])
     kappa_scan_fit_models_wrapper(input_file, config_data, output_dir)
@@ -7,8 +7,7 @@ import random
 import warnings
 import itertools
 import numpy as np
-import ruamel.yaml as yaml
-import matplotlib.pyplot as plt
+from ruamel.yaml import YAML
 from cytoolz import pluck, curried
 from collections import OrderedDict
 from os.path import join, exists, dirname
@@ -35,8 +34,8 @@ def process_indexfile(index, data_metadata, default_group="n/a", select_groups=F
     # if we have an index file, strip out the groups, match to the scores uuids
     if index is not None and exists(index):
         with open(index, "r") as f:
-            # reading in array of files
-            index_data = yaml.safe_load(f)
+            # reading in array of files; typ="safe" parses with libyaml when available
+            index_data = YAML(typ="safe").load(f)
             yml_metadata = index_data["files"]
 
         # reading corresponding groups and uuids
@@ -98,33 +97,52 @@ def select_data_to_model(index_data, data_dict, data_metadata, select_groups=Fal
         )
         if "," in groups_to_train:
             # Parse multiple inputted groups if comma is found
-            sel_groups = [g.strip() for g in groups_to_train.split(",")]
-            use_keys = [
-                f["uuid"] for f in index_data["files"] if f["group"] in sel_groups
-            ]
-            use_groups = [
-                f["group"] for f in index_data["files"] if f["uuid"] in use_keys
-            ]
+            sel_groups = {g.strip() for g in groups_to_train.split(",")}
+            use_keys, use_groups = _filter_files_by_group(
+                index_data["files"], sel_groups
+            )
         elif len(groups_to_train) > 0:
             # Parse multiple groups in case input is delimited by a space
-            sel_groups = [g for g in groups_to_train.split(" ")]
-            use_keys = [
-                f["uuid"] for f in index_data["files"] if f["group"] in sel_groups
-            ]
-            use_groups = [
-                f["group"] for f in index_data["files"] if f["uuid"] in use_keys
-            ]
+            sel_groups = set(groups_to_train.split(" "))
+            use_keys, use_groups = _filter_files_by_group(
+                index_data["files"], sel_groups
+            )
 
     use_groups = dict(zip(use_keys, use_groups))
 
-    data_dict = OrderedDict((k, data_dict[k]) for k in use_keys)
+    # only rebuild the dict if the selection drops or reorders sessions
+    if list(data_dict) != list(use_keys):
+        data_dict = OrderedDict((k, data_dict[k]) for k in use_keys)
     data_metadata["uuids"] = use_keys
     data_metadata["groups"] = use_groups
 
     return data_dict, data_metadata
 
 
-def prepare_model_metadata(data_dict, data_metadata, config_data):
+def _filter_files_by_group(files, sel_groups):
+    """
+    Get the uuids and groups of the index file entries belonging to the selected groups.
+
+    Args:
+    files (list): list of index file entries.
+    sel_groups (set): names of the groups to keep.
+
+    Returns:
+    use_keys (list): selected session uuids.
+    use_groups (list): groups of the selected session uuids.
+    """
+
+    use_keys = [f["uuid"] for f in files if f["group"] in sel_groups]
+    # set lookup keeps the group matching linear in the number of sessions
+    key_set = set(use_keys)
+    use_groups = [f["group"] for f in files if f["uuid"] in key_set]
+
+    return use_keys, use_groups
+
+
+def prepare_model_metadata(
+    data_dict, data_metadata, config_data, rng=None, inplace=False
+):
     """
     Set model training metadata parameters, whiten data, split data and return list of heldout keys if applicable, and update all dictionaries.
 
@@ -132,6 +150,10 @@ def prepare_model_metadata(data_dict, data_metadata, config_data):
     data_dict (OrderedDict): loaded data dictionary.
     data_metadata (OrderedDict): loaded metadata dictionary.
     config_data (dict): dictionary containing all modeling parameters.
+    rng (numpy.random.Generator): random number generator for unseeded hold-out splits and added noise.
+     A new one is created if None.
+    inplace (bool): whiten and add noise to the PC score arrays in data_dict in place when possible,
+     so they shouldn't be reused afterwards.
 
     Returns:
     data_dict (OrderedDict): optionally whitened and updated data dictionary.
@@ -140,6 +162,12 @@ def prepare_model_metadata(data_dict, data_metadata, config_data):
     hold_out_list (list): list of session uuids to hold out (if hold_out == True)
     """
 
+    if rng is None:
+        rng = np.random.default_rng()
+    if not inplace:
+        # whiten_each and the noise replace entries; leave the caller's dict alone
+        data_dict = OrderedDict(data_dict)
+
     if config_data["kappa"] is None:
         # Count total number of frames, then set it as kappa
         total_frames = count_frames(data_dict)
@@ -150,25 +178,26 @@ def prepare_model_metadata(data_dict, data_metadata, config_data):
     if config_data["hold_out"] and len(data_dict) >= config_data["nfolds"]:
         click.echo(f"Will hold out 1 fold of {config_data['nfolds']}")
 
+        all_keys = list(data_dict)
         if config_data["hold_out_seed"] >= 0:
             # Select repeatable random sessions to hold out
             click.echo(f"Settings random seed to {config_data['hold_out_seed']}")
+            # same draw as always, so a seed keeps selecting the same sessions
             rnd = random.Random(config_data["hold_out_seed"])
+            shuffled = rnd.sample(all_keys, len(all_keys))
         else:
             # Holding out sessions randomly
             warnings.warn(
                 "Random seed not set, will choose a different test set each time this is run..."
             )
-            rnd = random
-        # sample all uuids, split into nfolds
-        splits = np.array_split(
-            rnd.sample(list(data_dict), len(data_dict)), config_data["nfolds"]
-        )
+            shuffled = [all_keys[i] for i in rng.permutation(len(all_keys))]
+        # split the shuffled uuids into nfolds
+        splits = np.array_split(np.arange(len(shuffled)), config_data["nfolds"])
 
         # Make list of held out session uuids
-        hold_out = list(splits[0])
+        hold_out = [shuffled[i] for i in splits[0]]
         # Put remainder of the data in the training set
-        train = list(np.concatenate(splits[1:]))
+        train = [shuffled[i] for i in np.concatenate(splits[1:])]
         click.echo("Holding out " + str(hold_out))
         click.echo("Training on " + str(train))
     else:
@@ -200,28 +229,81 @@ def prepare_model_metadata(data_dict, data_metadata, config_data):
     if config_data["separate_trans"]:
         model_parameters["groups"] = {k: data_metadata["groups"][k] for k in train}
 
-    # Whiten the data
+    # Whiten the data, casting it to the training precision on the way
+    dtype = np.dtype(config_data.get("dtype", "float64"))
     whitening_parameters = None
     if config_data["whiten"][0].lower() == "a":
         click.echo("Whitening the training data using the whiten_all function")
         # in this case, whitening_parameters is a single tuple
-        data_dict, whitening_parameters = whiten_all(data_dict)
+        data_dict, whitening_parameters = whiten_all(
+            data_dict, dtype=dtype, inplace=inplace
+        )
     elif config_data["whiten"][0].lower() == "e":
         click.echo("Whitening the training data using the whiten_each function")
         # in this case, whitening_parameters is a dictionary of parameters
-        data_dict, whitening_parameters = whiten_each(data_dict)
+        data_dict, whitening_parameters = whiten_each(
+            data_dict, dtype=dtype, inplace=inplace
+        )
     else:
         click.echo("Not whitening the data")
+        data_dict = OrderedDict(
+            (k, v.astype(dtype, copy=False)) for k, v in data_dict.items()
+        )
 
     # Applying Additive White Gaussian Noise
     if config_data["noise_level"] > 0:
         click.echo(f'Using {config_data["noise_level"]} STD AWGN.')
-        for k, v in data_dict.items():
-            data_dict[k] = v + np.random.randn(*v.shape) * config_data["noise_level"]
+        # whitened scores are always fresh arrays, so they can take the noise in place
+        _add_white_noise(
+            data_dict,
+            config_data["noise_level"],
+            rng,
+            inplace=inplace or whitening_parameters is not None,
+        )
 
     return data_dict, model_parameters, train, hold_out, whitening_parameters
 
 
+def _add_white_noise(data_dict, noise_level, rng, inplace=False):
+    """
+    Add white gaussian noise to each session.
+
+    Args:
+    data_dict (OrderedDict): dictionary of uuid to PC score key-value pairs.
+    noise_level (float): standard deviation of the added noise.
+    rng (numpy.random.Generator): random number generator used to draw the noise.
+    inplace (bool): add the noise to the PC score arrays in place when possible.
+
+    Returns:
+    data_dict (OrderedDict): dictionary with noise added to the PC scores.
+    """
+
+    if len(data_dict) == 0:
+        return data_dict
+
+    # reuse a single noise buffer sized to the longest session
+    max_len = max(len(v) for v in data_dict.values())
+    buf = None
+    for k, v in data_dict.items():
+        if v.dtype not in (np.float32, np.float64):
+            data_dict[k] = v + rng.standard_normal(v.shape) * noise_level
+            continue
+        if not (inplace and v.flags.writeable):
+            # keep the training precision when adding the noise out of place
+            noise = rng.standard_normal(v.shape, dtype=v.dtype)
+            noise *= noise_level
+            data_dict[k] = v + noise
+            continue
+        if buf is None or buf.dtype != v.dtype or buf.shape[1:] != v.shape[1:]:
+            buf = np.empty((max_len,) + v.shape[1:], dtype=v.dtype)
+        noise = buf[: len(v)]
+        rng.standard_normal(noise.shape, dtype=v.dtype, out=noise)
+        noise *= noise_level
+        v += noise
+
+    return data_dict
+
+
 def get_heldout_data_splits(data_dict, train_list, hold_out_list):
     """
     Split data by session UUIDs into training and held out datasets.
@@ -260,7 +342,7 @@ def get_training_data_splits(split_frac, data_dict):
     validation_data = OrderedDict()
 
     for k, v in data_dict.items():
-        # Splitting data by test set
+        # Splitting data by test set; both halves are views into the session
         training_X, testing_X = (
             v[: int(len(v) * split_frac)],
             v[-int(len(v) * split_frac) :],
@@ -289,36 +371,43 @@ def graph_modeling_loglikelihoods(config_data, iter_lls, iter_holls, model_dir):
     img_path (str): path to saved graph.
     """
 
+    # only imported when plotting; matplotlib is slow to import
+    import matplotlib.pyplot as plt
+
     ll_type = "validation"
     if config_data["hold_out"]:
         ll_type = "held_out"
 
+    iter_lls = np.asarray(iter_lls)
     iterations = np.arange(len(iter_lls))
 
-    plt.plot(iterations, iter_lls, label="training")
+    # draw on a dedicated figure so repeated calls don't plot over each other
+    fig, ax = plt.subplots()
+    ax.plot(iterations, iter_lls, label="training")
     if len(iter_holls) > 0:
-        plt.plot(iterations, iter_holls, label=ll_type)
+        ax.plot(iterations, np.asarray(iter_holls), label=ll_type)
 
-    plt.legend()
-    plt.ylabel("Average Syllable Log-Likelihood")
-    plt.xlabel("Iterations")
+    ax.legend()
+    ax.set_ylabel("Average Syllable Log-Likelihood")
+    ax.set_xlabel("Iterations")
 
     # Saving plots
     if config_data["hold_out"]:
         img_path = join(model_dir, "train_heldout_summary.png")
-        plt.title(
+        ax.set_title(
             "ARHMM Training Summary With " + str(config_data["nfolds"]) + " Folds"
         )
-        plt.savefig(img_path, dpi=300)
     else:
         img_path = join(
             model_dir, f'train_val{config_data["percent_split"]}_summary.png'
         )
-        plt.title(
+        ax.set_title(
             "ARHMM Training Summary With "
             + str(config_data["percent_split"])
             + "% Train-Val Split"
         )
-        plt.savefig(img_path, dpi=300)
+    fig.savefig(img_path, dpi=300)
+    # release the figure; scan workers plot once for every model they fit
+    plt.close(fig)
 
     return img_path
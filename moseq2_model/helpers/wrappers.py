@@ -4,22 +4,31 @@ Wrapper functions for CLI and GUI.
 
 import os
 import sys
-import glob
 import click
+import shlex
+import subprocess
 import numpy as np
-from copy import deepcopy
-from cytoolz import valmap
-from moseq2_model.train.util import train_model, run_e_step, apply_model
+from concurrent.futures import ProcessPoolExecutor
+from moseq2_model.train.util import (
+    train_model,
+    run_e_step,
+    apply_model,
+    label_dtype,
+    pad_labels,
+)
 from os.path import join, basename, realpath, dirname, splitext
 from moseq2_model.util import (
     save_dict,
     load_pcs,
     get_parameters_from_model,
-    copy_model,
+    detached_data,
     get_scan_range_kappas,
+    get_parameter_strings,
     create_command_strings,
     get_current_model,
-    get_loglikelihoods,
+    count_frames,
+    find_checkpoints,
+    get_loglikelihoods_pair,
     get_session_groupings,
     load_dict,
 )
@@ -71,7 +80,8 @@ def learn_model_wrapper(input_file, dest_file, config_data):
 
     click.echo("Entering modeling training")
 
-    run_parameters = deepcopy(config_data)
+    # snapshot of the run's config; later changes to config_data aren't recorded
+    run_parameters = _snapshot(config_data)
 
     # Get session PC scores and session metadata dicts
     data_dict, data_metadata = load_pcs(
@@ -98,12 +108,12 @@ def learn_model_wrapper(input_file, dest_file, config_data):
             index_data, data_dict, data_metadata, select_groups
         )
 
-    all_keys = list(data_dict)
-    groups = list(data_metadata["groups"].values())
-
-    # Get train/held out data split uuids
+    # Get train/held out data split uuids; a seed makes the noise and folds repeatable
+    rng = np.random.default_rng(config_data.get("seed"))
     data_dict, model_parameters, train_list, hold_out_list, whitening_parameters = (
-        prepare_model_metadata(data_dict, data_metadata, config_data)
+        prepare_model_metadata(
+            data_dict, data_metadata, config_data, rng=rng, inplace=True
+        )
     )
 
     # Pack data dicts corresponding to uuids in train_list and hold_out_list
@@ -121,9 +131,10 @@ def learn_model_wrapper(input_file, dest_file, config_data):
         train_data = data_dict
         test_data = None
 
-    # Get all saved checkpoints
-    checkpoint_file = basename(dest_file).replace(".p", "")
-    all_checkpoints = glob.glob(join(checkpoint_path, f"{checkpoint_file}*.arhmm"))
+    # Get all saved checkpoints, including ones named the way older versions did
+    checkpoint_file = splitext(basename(dest_file))[0]
+    legacy_file = basename(dest_file).replace(".p", "")
+    all_checkpoints = find_checkpoints(checkpoint_path, checkpoint_file, legacy_file)
 
     # Instantiate model; either anew or from previously saved checkpoint
     arhmm, itr = get_current_model(
@@ -140,7 +151,7 @@ def learn_model_wrapper(input_file, dest_file, config_data):
     }
 
     # Get data groupings for verbose train vs. test log-likelihood estimation and graphing
-    if hold_out_list is not None and groups is not None:
+    if hold_out_list is not None and data_metadata["groups"] is not None:
         groupings = get_session_groupings(data_metadata, train_list, hold_out_list)
     else:
         groupings = None
@@ -163,18 +174,19 @@ def learn_model_wrapper(input_file, dest_file, config_data):
     )
 
     click.echo("Computing likelihoods on each training dataset...")
-    # Get training log-likelihoods
-    train_ll = get_loglikelihoods(
-        arhmm, train_data, groupings[0], config_data["separate_trans"]
-    )
-
-    heldout_ll = []
-    # Get held out log-likelihoods
     if config_data["hold_out"]:
         click.echo("Computing held out likelihoods with separate transition matrix...")
-        heldout_ll = get_loglikelihoods(
-            arhmm, test_data, groupings[1], config_data["separate_trans"]
-        )
+    # Get training and held out log-likelihoods
+    train_ll, heldout_ll = get_loglikelihoods_pair(
+        arhmm,
+        train_data,
+        test_data if config_data["hold_out"] else None,
+        groupings,
+        config_data["separate_trans"],
+        ncpus=config_data["ncpus"],
+    )
+    if heldout_ll is None:
+        heldout_ll = []
 
     save_parameters = get_parameters_from_model(arhmm)
 
@@ -189,12 +201,12 @@ def learn_model_wrapper(input_file, dest_file, config_data):
     export_dict = {
         "loglikes": loglikes,
         "labels": labels,
-        "keys": all_keys,
+        "keys": list(data_dict),
         "heldout_ll": heldout_ll,
         "model_parameters": save_parameters,
         "run_parameters": run_parameters,
         "metadata": data_metadata,
-        "model": copy_model(arhmm) if config_data.get("save_model", True) else None,
+        "model": arhmm if config_data.get("save_model", True) else None,
         "hold_out_list": hold_out_list,
         "train_list": train_list,
         "train_ll": train_ll,
@@ -203,8 +215,9 @@ def learn_model_wrapper(input_file, dest_file, config_data):
         "pc_score_path": os.path.abspath(input_file),
     }
 
-    # Save model
-    save_dict(filename=dest_file, obj_to_save=export_dict)
+    # Save model; the training data is left out of the pickle without copying the model
+    with detached_data(arhmm):
+        save_dict(filename=dest_file, obj_to_save=export_dict)
 
     if interrupt:
         raise KeyboardInterrupt()
@@ -216,6 +229,27 @@ def learn_model_wrapper(input_file, dest_file, config_data):
         return img_path
 
 
+def _snapshot(config_data):
+    """
+    Take a shallow copy of the config data, with numpy values converted to python types.
+
+    Args:
+    config_data (dict): Dictionary containing model training parameters
+
+    Returns:
+    (dict): plain copy of config_data to store with the model
+    """
+
+    def _plain(v):
+        if isinstance(v, np.ndarray):
+            return v.tolist()
+        if isinstance(v, np.generic):
+            return v.item()
+        return v
+
+    return {k: _plain(v) for k, v in config_data.items()}
+
+
 def apply_model_wrapper(model_file, pc_file, dest_file, config_data):
     """
     Wrapper function to apply a pre-trained model to new data.
@@ -276,7 +310,8 @@ def apply_model_wrapper(model_file, pc_file, dest_file, config_data):
 
     # add -5 padding to the list of states
     nlags = model_data["run_parameters"].get("nlags", 3)
-    syllables = valmap(lambda v: np.concatenate(([-5] * nlags, v)), syllables)
+    dtype = label_dtype(model_data["model"].num_states)
+    syllables = {k: pad_labels(v, nlags, dtype) for k, v in syllables.items()}
 
     # prepare model data dictionary to save
     # save applied model data
@@ -311,15 +346,19 @@ def kappa_scan_fit_models_wrapper(input_file, config_data, output_dir):
         "out_script" in config_data
     ), "Need to supply out_script to save modeling commands"
 
+    # only the frame count is needed here, and a frame's NaNs show up in its first PC
     data_dict, _ = load_pcs(
         filename=input_file,
         var_name=config_data.get("var_name", "scores"),
-        npcs=config_data["npcs"],
+        npcs=1,
         load_groups=config_data["load_groups"],
     )
+    nframes = count_frames(data_dict)
+    # the scores are only needed to pick kappas; free them before forking workers
+    del data_dict
 
     # Get list of kappa values for spooling models
-    kappas = get_scan_range_kappas(data_dict, config_data)
+    kappas = get_scan_range_kappas(None, config_data, nframes=nframes)
 
     # Get model training command strings
     command_string = create_command_strings(input_file, output_dir, config_data, kappas)
@@ -338,11 +377,71 @@ def kappa_scan_fit_models_wrapper(input_file, config_data, output_dir):
     if config_data["run_cmd"]:
         # Or run the kappa scan
         print("Running kappa scan commands")
-        os.system(command_string)
+        if config_data["cluster_type"] == "local":
+            fit_kappa_scan_models(input_file, output_dir, config_data, kappas)
+        else:
+            # the script runs in a shell so prefixes can use shell syntax; its `set -e`
+            # stops at the first failed submission, which check=True then raises
+            subprocess.run(command_string, shell=True, check=True)
 
     return command_string
 
 
+def fit_kappa_scan_models(input_file, output_dir, config_data, kappas):
+    """
+    Train the kappa scan models on the local machine, optionally fitting several models in parallel.
+
+    Args:
+    input_file (str): Path to PC Scores
+    output_dir (str): Path to output directory to save trained models
+    config_data (dict): Dictionary containing kappa scan parameters; max_workers sets how many models are fit at once
+    kappas (list): List of kappa values to train models with
+    """
+
+    # imported here to avoid a circular import with the CLI
+    from moseq2_model.cli import learn_model
+
+    if len(kappas) == 0:
+        print("No kappa values to scan")
+        return
+
+    # every model loads the full PC dataset, so only fit in parallel when asked to
+    max_workers = max(config_data.get("max_workers") or 1, 1)
+
+    # parse the same learn-model flags the saved script passes, so the models fit here
+    # match the ones the script trains
+    parameters, _ = get_parameter_strings(config_data)
+    tasks = []
+    for i, k in enumerate(kappas):
+        # models are named the same way as in create_command_strings
+        dest_file = join(output_dir, "model-{:03d}-{}.p".format(i, k))
+        args = [input_file, dest_file] + shlex.split(parameters) + ["--kappa", f"{k}"]
+        model_config = learn_model.make_context("learn-model", args).params
+        tasks.append(
+            (
+                model_config.pop("input_file"),
+                model_config.pop("dest_file"),
+                model_config,
+            )
+        )
+
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        # consume the results to raise any errors from the workers
+        list(executor.map(_fit_kappa_scan_model, tasks))
+
+
+def _fit_kappa_scan_model(task):
+    """
+    Train a single kappa scan model; picklable entry point for the worker processes.
+
+    Args:
+    task (tuple): input file, destination file and config data of the model to train.
+    """
+
+    input_file, dest_file, config_data = task
+    learn_model_wrapper(input_file, dest_file, config_data)
+
+
 def count_frames_wrapper(input_file):
     # count frames from pc scores
     pass
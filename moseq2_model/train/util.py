@@ -4,10 +4,16 @@ ARHMM utility functions
 
 import numpy as np
 from tqdm.auto import tqdm
-from functools import partial
+from scipy.linalg import solve_triangular
 from cytoolz import valmap, itemmap
 from collections import OrderedDict, defaultdict
-from moseq2_model.util import save_arhmm_checkpoint, get_loglikelihoods
+from concurrent.futures import ThreadPoolExecutor
+from moseq2_model.util import (
+    save_arhmm_checkpoint,
+    get_loglikelihoods_pair,
+    snapshot_model,
+    load_model_snapshot,
+)
 
 
 def train_model(
@@ -57,40 +63,49 @@ def train_model(
 
     iter_lls, iter_holls = [], []
 
-    for itr in tqdm(range(start, num_iter), **progress_kwargs, desc="Training ARHMM"):
-        # Resample states, and gracefully return in case of a keyboard interrupt
-        try:
-            model.resample_model(num_procs=ncpus)
-        except KeyboardInterrupt:
-            print("Training manually interrupted.")
-            print("Returning and saving current iteration of model. ")
-            return (
-                model,
-                model.log_likelihood(),
-                get_labels_from_model(model),
-                iter_lls,
-                iter_holls,
-                True,
-            )
-
-        summ_stats = {
-            "model": model,
-            "groups": groups,
-            "train_data": train_data,
-            "val_data": val_data,
-            "separate_trans": separate_trans,
-        }
-
-        if verbose and ((itr + 1) % check_every == 0):
-            # Compute and save iteration training and validation log-likelihoods
-            train_ll, ho_ll = get_model_summary(**summ_stats)
-            iter_lls.append(train_ll)
-            if ho_ll is not None:
-                iter_holls.append(ho_ll)
-
-        # checkpoint if needed
-        if checkpoint and ((itr + 1) % checkpoint_freq == 0):
-            training_checkpoint(model, itr, checkpoint_file)
+    # checkpoints are written in the background while the sampler keeps going
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for itr in tqdm(
+            range(start, num_iter), **progress_kwargs, desc="Training ARHMM"
+        ):
+            # Resample states, and gracefully return in case of a keyboard interrupt
+            try:
+                model.resample_model(num_procs=ncpus)
+            except KeyboardInterrupt:
+                print("Training manually interrupted.")
+                print("Returning and saving current iteration of model. ")
+                interrupt = True
+                break
+
+            summ_stats = {
+                "model": model,
+                "groups": groups,
+                "train_data": train_data,
+                "val_data": val_data,
+                "separate_trans": separate_trans,
+                "ncpus": ncpus,
+            }
+
+            if verbose and ((itr + 1) % check_every == 0):
+                # Compute and save iteration training and validation log-likelihoods
+                train_ll, ho_ll = get_model_summary(**summ_stats)
+                iter_lls.append(train_ll)
+                if ho_ll is not None:
+                    iter_holls.append(ho_ll)
+
+            # checkpoint if needed
+            if checkpoint and ((itr + 1) % checkpoint_freq == 0):
+                # only one checkpoint in flight at a time
+                if pending is not None:
+                    pending.result()
+                pending = training_checkpoint(model, itr, checkpoint_file, executor)
+        else:
+            interrupt = False
+
+        # surface errors from the last checkpoint write
+        if pending is not None:
+            pending.result()
 
     return (
         model,
@@ -98,11 +113,11 @@ def train_model(
         get_labels_from_model(model),
         iter_lls,
         iter_holls,
-        False,
+        interrupt,
     )
 
 
-def training_checkpoint(model, itr, checkpoint_file):
+def training_checkpoint(model, itr, checkpoint_file, executor=None):
     """
     Format the model checkpoint filename and save the model checkpoint
 
@@ -110,6 +125,11 @@ def training_checkpoint(model, itr, checkpoint_file):
     model (ARHMM): Model object being trained.
     itr (itr): Current modeling iteration.
     checkpoint_file (str): Model checkpoint filename.
+    executor (concurrent.futures.Executor): if given, the checkpoint is written in the
+     background from a snapshot of the model.
+
+    Returns:
+    future (concurrent.futures.Future): pending checkpoint write if executor is given.
     """
 
     # Pack the data to save in checkpoint
@@ -124,10 +144,28 @@ def training_checkpoint(model, itr, checkpoint_file):
     checkpoint_file = f"{checkpoint_file}-checkpoint_{itr}.arhmm"
 
     # Save checkpoint
+    if executor is not None:
+        # only the pickling happens on the sampler thread; the model is rebuilt from
+        # the bytes and written in the background, so no live copy waits in the queue
+        save_data["model"] = snapshot_model(model)
+        return executor.submit(_save_checkpoint_snapshot, checkpoint_file, save_data)
     save_arhmm_checkpoint(checkpoint_file, save_data)
 
 
-def get_model_summary(model, groups, train_data, val_data, separate_trans):
+def _save_checkpoint_snapshot(checkpoint_file, save_data):
+    """
+    Save a checkpoint whose model was packed with snapshot_model.
+
+    Args:
+    checkpoint_file (str): Model checkpoint filename.
+    save_data (dict): checkpoint contents, with the model snapshot under "model".
+    """
+
+    save_data["model"] = load_model_snapshot(save_data["model"])
+    save_arhmm_checkpoint(checkpoint_file, save_data)
+
+
+def get_model_summary(model, groups, train_data, val_data, separate_trans, ncpus=1):
     """
     Compute log-likelihood of train_data and val_data (if not None) when verbose is True.
 
@@ -137,36 +175,57 @@ def get_model_summary(model, groups, train_data, val_data, separate_trans):
     train_data (OrderedDict): Ordered dict of training data
     val_data: (OrderedDict or None): Ordered dict of validation/held-out data
     separate_trans (bool): boolean flag that indicates whether to separate log-likelihoods for each group.
+    ncpus (int): number of processes used to compute the session log-likelihoods in parallel
 
     Returns:
     train_ll (float): normalized average training log-likelihoods across all recording sessions.
     val_ll (float): normalized average held-out log-likelihood across all recording sessions.
     """
-    # Get train and validation groups
-    if groups is not None:
-        train_groups, val_groups = groups
-    else:
-        # if there are no groups, separate trans cannot be True
-        separate_trans = False
-        train_groups, val_groups = None, None
-
     # Compute normalized log-likelihoods for each session
-    train_ll = get_loglikelihoods(
-        model, train_data, train_groups, separate_trans, normalize=True
+    train_ll, val_ll = get_loglikelihoods_pair(
+        model, train_data, val_data, groups, separate_trans, normalize=True, ncpus=ncpus
     )
 
     # return early if there is no validation data
-    if val_data is None:
+    if val_ll is None:
         return np.mean(train_ll), None
 
-    # Get iteration heldout/validation log-likelihood values
-    val_ll = get_loglikelihoods(
-        model, val_data, val_groups, separate_trans, normalize=True
-    )
-
     return np.mean(train_ll), np.mean(val_ll)
 
 
+def label_dtype(num_states):
+    """
+    Get the dtype syllable labels are saved with; at least int16, wider only if num_states needs it.
+
+    Args:
+    num_states (int): number of states in the model
+
+    Returns:
+    dtype (numpy.dtype): signed integer dtype that fits the -5 padding and all state labels
+    """
+
+    return np.promote_types(np.int16, np.min_scalar_type(-num_states))
+
+
+def pad_labels(labels, nlags, dtype):
+    """
+    Prepend the -5 padding for the first nlags frames to a session's syllable labels.
+
+    Args:
+    labels (numpy.ndarray): syllable labels of one session
+    nlags (int): number of frames the AR model can't label
+    dtype (numpy.dtype): dtype of the padded labels
+
+    Returns:
+    out (numpy.ndarray): padded syllable labels
+    """
+
+    out = np.empty(len(labels) + nlags, dtype=dtype)
+    out[:nlags] = -5
+    out[nlags:] = labels
+    return out
+
+
 def get_labels_from_model(model):
     """
     Grab model labels for each training dataset and place them in a list.
@@ -178,9 +237,8 @@ def get_labels_from_model(model):
     labels (list): An array of predicted syllable labels for each training session
     """
 
-    labels = [
-        np.append(np.repeat(-5, model.nlags), s.stateseq) for s in model.states_list
-    ]
+    dtype = label_dtype(model.num_states)
+    labels = [pad_labels(s.stateseq, model.nlags, dtype) for s in model.states_list]
     return labels
 
 
@@ -205,7 +263,7 @@ def apply_model(model, whitening_params, data_dict, metadata, whiten="all"):
         whitening_params["L"],
         whitening_params["offset"],
     )
-    apply_whitening = lambda x: np.linalg.solve(L, (x - mu).T).T + offset
+    apply_whitening = lambda x: _whiten(x, mu, L) + offset
 
     # check for whiten parameters to see if whiten_all or whiten_each
     if whiten[0].lower() == "e":
@@ -231,14 +289,33 @@ def apply_model(model, whitening_params, data_dict, metadata, whiten="all"):
     return labels
 
 
+def _whiten(x, mu, L):
+    """
+    Whiten data with the lower-triangular Cholesky factor of its covariance matrix.
+
+    Args:
+    x (np.ndarray): PC scores (frames x pcs)
+    mu (np.ndarray): mean PC score
+    L (np.ndarray): lower-triangular Cholesky factor of the PC score covariance
+
+    Returns:
+    (np.ndarray): whitened PC scores
+    """
+
+    # forward substitution instead of a general LU solve; NaN frames stay NaN
+    return solve_triangular(L, (x - mu).T, lower=True, check_finite=False).T
+
+
 # taken from moseq by @mattjj and @alexbw
-def whiten_all(data_dict, center=True):
+def whiten_all(data_dict, center=True, dtype=np.float64, inplace=False):
     """
     Whiten the PC Scores (with Cholesky decomposition) using all the data to compute the covariance matrix.
 
     Args:
     data_dict (OrderedDict): Training dataset
     center (bool): Indicates whether to center data by subtracting the mean PC score.
+    dtype (np.dtype): data type of the whitened PC scores
+    inplace (bool): overwrite the arrays in data_dict with their whitened scores when their layout and dtype allow it
 
     Returns:
     data_dict (OrderedDict): Whitened training data dictionary
@@ -246,36 +323,56 @@ def whiten_all(data_dict, center=True):
 
     non_nan = lambda x: x[~np.isnan(np.reshape(x, (x.shape[0], -1))).any(1)]
     meancov = lambda x: (x.mean(0), np.cov(x, rowvar=False, bias=1))
-    contig = partial(np.require, dtype=np.float64, requirements="C")
 
     mu, Sigma = meancov(np.concatenate(list(map(non_nan, data_dict.values()))))
     L = np.linalg.cholesky(Sigma)
 
     offset = 0.0 if center else mu
     # set up function to whiten data
-    apply_whitening = lambda x: np.linalg.solve(L, (x - mu).T).T + offset
+    apply_whitening = lambda x: _whiten(x, mu, L) + offset
     whitening_parameters = {"mu": mu, "L": L, "offset": offset}
-    return (
-        OrderedDict((k, contig(apply_whitening(v))) for k, v in data_dict.items()),
-        whitening_parameters,
+
+    # pack the sessions that aren't overwritten into one C-contiguous buffer and hand out
+    # row views of it, which the ARHMM can lag (AR_striding) without copying
+    overwritable = lambda v: (
+        v.flags.writeable and v.flags.c_contiguous and v.dtype == dtype
     )
+    packed_keys = [k for k, v in data_dict.items() if not (inplace and overwritable(v))]
+    bounds = np.cumsum([0] + [len(data_dict[k]) for k in packed_keys])
+    packed = np.empty((bounds[-1], L.shape[0]), dtype=dtype)
+    outputs = {
+        k: packed[start:stop]
+        for k, start, stop in zip(packed_keys, bounds[:-1], bounds[1:])
+    }
+
+    whitened = OrderedDict()
+    for k, v in data_dict.items():
+        out = outputs.get(k, v)
+        out[...] = apply_whitening(v)
+        whitened[k] = out
+
+    return whitened, whitening_parameters
 
 
 # taken from moseq by @mattjj and @alexbw
-def whiten_each(data_dict, center=True):
+def whiten_each(data_dict, center=True, dtype=np.float64, inplace=False):
     """
     Whiten the PC scores for each training dataset separately.
 
     Args:
     data_dict (OrderedDict): Training dataset
     center (bool): Boolean flag that indicates whether to center data by subtracting the mean PC score.
+    dtype (np.dtype): data type of the whitened PC scores
+    inplace (bool): overwrite the arrays in data_dict with their whitened scores when their layout and dtype allow it
 
     Returns:
     data_dict (OrderedDict): Whitened training data dictionary
     """
     whitening_parameters = {}
     for k, v in data_dict.items():
-        tmp_dict, whitening_parameters[k] = whiten_all({k: v}, center=center)
+        tmp_dict, whitening_parameters[k] = whiten_all(
+            {k: v}, center=center, dtype=dtype, inplace=inplace
+        )
         data_dict[k] = tmp_dict[k]
 
     return data_dict, whitening_parameters
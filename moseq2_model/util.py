@@ -2,21 +2,35 @@
 Utility functions for handling loading and saving models and their respective metadata.
 """
 
+import io
 import os
 import re
+import pickle
 import h5py
 import click
 import joblib
 import scipy.io
 import warnings
 import numpy as np
-from copy import deepcopy
 from cytoolz import first
+from itertools import repeat
+from contextlib import contextmanager
 from collections import OrderedDict
-from moseq2_model.train.models import ARHMM
-from autoregressive.util import AR_striding
 from os.path import basename, getctime, join, exists
 
+try:
+    # joblib picks up lz4 when it's installed; much faster than zlib for checkpoints
+    import lz4  # noqa: F401
+
+    _CHECKPOINT_COMPRESSION = ("lz4", 3)
+except ImportError:
+    _CHECKPOINT_COMPRESSION = ("zlib", 5)
+
+# gzip and shuffle are standard HDF5 filters, so MATLAB and other HDF5 tools can still
+# read the results; the lowest gzip level is much faster and shuffling keeps the ratio
+_H5_COMPRESSION = {"compression": "gzip", "compression_opts": 1}
+_H5_ARRAY_COMPRESSION = {**_H5_COMPRESSION, "shuffle": True}
+
 
 def load_pcs(filename, var_name="features", load_groups=False, npcs=10):
     """
@@ -53,20 +67,27 @@ def load_pcs(filename, var_name="features", load_groups=False, npcs=10):
 
     elif filename.endswith((".z", ".pkl", ".p")):
         print("Loading data from pickle file")
-        data_dict = joblib.load(filename)
+        # memory-map uncompressed pickles so only the requested PCs are read into memory
+        mmap_mode = None if filename.endswith(".z") else "r"
+        data_dict = joblib.load(filename, mmap_mode=mmap_mode)
 
         if not isinstance(data_dict, OrderedDict):
             data_dict = OrderedDict(data_dict)
 
+        def _select_pcs(v):
+            v = v[:, :npcs]
+            # copy mapped scores into writable memory, detached from the file
+            return np.array(v) if isinstance(v, np.memmap) else v
+
         # Reading in PCs and associated groups
         if isinstance(first(data_dict.values()), tuple):
             print("Detected tuple")
             for k, v in data_dict.items():
-                data_dict[k] = v[0][:, :npcs]
+                data_dict[k] = _select_pcs(v[0])
                 metadata["groups"][k] = v[1]
         else:
             for k, v in data_dict.items():
-                data_dict[k] = v[:, :npcs]
+                data_dict[k] = _select_pcs(v)
 
         metadata["uuids"] = list(data_dict)
 
@@ -83,14 +104,17 @@ def load_pcs(filename, var_name="features", load_groups=False, npcs=10):
 
                 elif isinstance(tmp, h5py.Group):
                     # Reading in PCs
-                    data_dict = OrderedDict([(k, v[:, :npcs]) for k, v in tmp.items()])
+                    data_dict = _read_h5_sessions(tmp, npcs)
                     # Optionally loading groups if they
                     if load_groups:
                         if "groups" in f:
+                            # read the groups and metadata keys once instead of per session
+                            groups = f["groups"][()]
+                            metadata_keys = set(f["metadata"])
                             metadata["groups"] = {
-                                key: f["groups"][i]
+                                key: groups[i]
                                 for i, key in enumerate(data_dict)
-                                if key in f["metadata"]
+                                if key in metadata_keys
                             }
                         else:
                             warnings.warn(
@@ -120,6 +144,46 @@ def load_pcs(filename, var_name="features", load_groups=False, npcs=10):
     return data_dict, metadata
 
 
+def _read_h5_sessions(group, npcs):
+    """
+    Read the PC scores of every session in an h5 group into one contiguous buffer.
+
+    Args:
+    group (h5py.Group): h5 group with one PC score dataset per session
+    npcs (int): Number of PCs to load
+
+    Returns:
+    data_dict (OrderedDict): key-value pairs for keys being uuids and values being views
+     of the session's PC scores in the shared buffer.
+    """
+
+    dsets = list(group.items())
+    dtypes = {v.dtype for _, v in dsets}
+    widths = {min(v.shape[1], npcs) for _, v in dsets}
+    if len(dtypes) != 1 or len(widths) != 1:
+        # sessions with different layouts can't share a buffer
+        return OrderedDict((k, v[:, :npcs]) for k, v in dsets)
+
+    bounds = np.cumsum([0] + [len(v) for _, v in dsets])
+    packed = np.empty((bounds[-1], widths.pop()), dtype=dtypes.pop())
+
+    data_dict = OrderedDict()
+    for (k, v), start, stop in zip(dsets, bounds[:-1], bounds[1:]):
+        if stop > start:
+            # read straight into the session's rows of the buffer
+            v.read_direct(packed, np.s_[:, :npcs], np.s_[start:stop])
+        data_dict[k] = packed[start:stop]
+
+    return data_dict
+
+
+# compiled once; is_uuid is called for every session key
+_UUID_REGEX = re.compile(
+    "^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}\Z",
+    re.I,
+)
+
+
 def is_uuid(string):
     """
     Check to see if string is a uuid.
@@ -130,14 +194,43 @@ def is_uuid(string):
     Returns:
     (bool): boolean to indicate if a string is a uuid.
     """
-    regex = re.compile(
-        "^[a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}\Z",
-        re.I,
-    )
-    match = regex.match(string)
+    match = _UUID_REGEX.match(string)
     return bool(match)
 
 
+def find_checkpoints(checkpoint_path, checkpoint_file, legacy_file=None):
+    """
+    Find the saved checkpoints of a model, in one pass over the checkpoint directory.
+
+    Args:
+    checkpoint_path (str): directory the checkpoints are saved in
+    checkpoint_file (str): model name the checkpoints were saved under
+    legacy_file (str): older model name the checkpoints may have been saved under
+
+    Returns:
+    all_checkpoints (list): checkpoint paths ordered from oldest to newest
+    """
+
+    if not exists(checkpoint_path):
+        return []
+
+    # names follow training_checkpoint's format
+    prefixes = tuple(
+        f"{name}-checkpoint_" for name in (checkpoint_file, legacy_file) if name
+    )
+    with os.scandir(checkpoint_path) as it:
+        entries = [
+            e
+            for e in it
+            if e.name.startswith(prefixes)
+            and e.name.endswith(".arhmm")
+            and e.is_file()
+        ]
+    entries.sort(key=lambda e: e.stat().st_ctime)
+
+    return [e.path for e in entries]
+
+
 def get_current_model(use_checkpoint, all_checkpoints, train_data, model_parameters):
     """
     Load the latest model checkpoint of use_checkppoint parameter is True, otherwise instantiate a new model.
@@ -153,6 +246,9 @@ def get_current_model(use_checkpoint, all_checkpoints, train_data, model_paramet
     itr (int): starting iteration number for the model to begin training from.
     """
 
+    # imported here so loading PC scores doesn't pull in the modeling libraries
+    from moseq2_model.train.models import ARHMM
+
     # Check for available previous modeling checkpoints
     itr = 0
     if use_checkpoint and len(all_checkpoints) > 0:
@@ -177,7 +273,7 @@ def get_current_model(use_checkpoint, all_checkpoints, train_data, model_paramet
     return arhmm, itr
 
 
-def get_loglikelihoods(arhmm, data, groups, separate_trans, normalize=True):
+def get_loglikelihoods(arhmm, data, groups, separate_trans, normalize=True, ncpus=1):
     """
     Compute the log-likelihoods of the training sessions.
 
@@ -187,19 +283,126 @@ def get_loglikelihoods(arhmm, data, groups, separate_trans, normalize=True):
     groups (list): list of assigned groups for all corresponding session uuids.
     separate_trans (bool): flag to compute separate log-likelihoods for each modeled group.
     normalize (bool): if set to True this function will normalize by frame counts in each session
+    ncpus (int): number of processes used to compute the session log-likelihoods in parallel
 
     Returns:
     ll (list): list of log-likelihoods for the trained model
     """
 
-    if separate_trans:
-        ll = [
-            arhmm.log_likelihood(v, group_id=g) for g, v in zip(groups, data.values())
-        ]
+    if not separate_trans:
+        groups = repeat(None)
+
+    return _loglikelihoods(arhmm, list(zip(groups, data.values())), normalize, ncpus)
+
+
+def get_loglikelihoods_pair(
+    arhmm, train_data, test_data, groupings, separate_trans, normalize=True, ncpus=1
+):
+    """
+    Compute the log-likelihoods of the training and held-out sessions in one pass.
+
+    Args:
+    arhmm (ARHMM): the ARHMM model object.
+    train_data (dict): dict object with UUID keys containing the training PCS.
+    test_data (dict or None): dict object with UUID keys containing the held-out PCS.
+    groupings (tuple or None): train and held-out groups, as returned by get_session_groupings.
+    separate_trans (bool): flag to compute separate log-likelihoods for each modeled group.
+    normalize (bool): if set to True this function will normalize by frame counts in each session
+    ncpus (int): number of processes used to compute the session log-likelihoods in parallel
+
+    Returns:
+    train_ll (list): list of log-likelihoods of the training sessions
+    test_ll (list or None): list of log-likelihoods of the held-out sessions, None without test_data
+    """
+
+    if groupings is None or not separate_trans:
+        train_groups, test_groups = repeat(None), repeat(None)
+    else:
+        train_groups, test_groups = groupings
+
+    # compute both partitions in one batched pass, so each worker gets the model once
+    sessions = list(zip(train_groups, train_data.values()))
+    ntrain = len(sessions)
+    if test_data is not None:
+        sessions += zip(test_groups, test_data.values())
+
+    ll = _loglikelihoods(arhmm, sessions, normalize, ncpus)
+
+    if test_data is None:
+        return ll, None
+    return ll[:ntrain], ll[ntrain:]
+
+
+def _loglikelihoods(arhmm, sessions, normalize=True, ncpus=1):
+    """
+    Compute the log-likelihoods of a list of sessions.
+
+    Args:
+    arhmm (ARHMM): the ARHMM model object.
+    sessions (list): list of (group_id, PC scores) tuples; group_id is None without separate_trans
+    normalize (bool): if set to True this function will normalize by frame counts in each session
+    ncpus (int): number of processes used to compute the session log-likelihoods in parallel
+
+    Returns:
+    ll (list): list of log-likelihoods for each session
+    """
+
+    # sessions are independent; only parallelize when it outweighs the process overhead
+    if ncpus > 1 and len(sessions) > 4:
+        # one contiguous batch of sessions per worker, so the model (copied without its
+        # training data) is pickled once per worker instead of once per session.
+        # joblib reuses the loky workers across calls, so repeated summaries don't
+        # start a new pool each time
+        mdl = copy_model(arhmm)
+        nbatches = min(ncpus, len(sessions))
+        bounds = np.linspace(0, len(sessions), nbatches + 1, dtype=int)
+        batches = joblib.Parallel(n_jobs=nbatches, backend="loky")(
+            joblib.delayed(_batch_loglikelihoods)(mdl, sessions[start:stop], normalize)
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        )
+        ll = [x for batch in batches for x in batch]
     else:
-        ll = [arhmm.log_likelihood(v) for v in data.values()]
+        ll = _batch_loglikelihoods(arhmm, sessions, normalize)
+
+    return ll
+
+
+def _batch_loglikelihoods(arhmm, sessions, normalize=True):
+    """
+    Compute the log-likelihoods of a batch of sessions in order.
+
+    Args:
+    arhmm (ARHMM): the ARHMM model object.
+    sessions (list): list of (group_id, PC scores) tuples
+    normalize (bool): if set to True this function will normalize by frame counts in each session
+
+    Returns:
+    ll (list): list of log-likelihoods for each session
+    """
+
+    return [_session_loglikelihood(arhmm, v, g, normalize) for g, v in sessions]
+
+
+def _session_loglikelihood(arhmm, data, group_id=None, normalize=True):
+    """
+    Compute the log-likelihood of a single session.
+
+    Args:
+    arhmm (ARHMM): the ARHMM model object.
+    data (np.ndarray): PC scores of the session.
+    group_id (str or None): group of the session; only used with separate transition matrices.
+    normalize (bool): if set to True the log-likelihood is normalized by the session's frame count
+
+    Returns:
+    ll (float): log-likelihood of the session
+    """
+
+    if group_id is None:
+        ll = arhmm.log_likelihood(data)
+    else:
+        ll = arhmm.log_likelihood(data, group_id=group_id)
     if normalize:
-        ll = [l / len(v) for l, v in zip(ll, data.values())]
+        ll /= len(data)
 
     return ll
 
@@ -210,7 +413,7 @@ def get_session_groupings(data_metadata, train_list, hold_out_list):
 
     Args:
     data_metadata (dict): dict containing session group information
-    all_keys (list): list of all corresponding included session uuids
+    train_list (list): list of training uuids
     hold_out_list (list): list of held-out uuids
 
     Returns:
@@ -218,9 +421,10 @@ def get_session_groupings(data_metadata, train_list, hold_out_list):
     and held-out groups (if held_out_list exists)
     """
 
-    # Get held out groups
-    hold_g = [data_metadata["groups"][k] for k in hold_out_list]
-    train_g = [data_metadata["groups"][k] for k in train_list]
+    # Get train and held out groups with one lookup per session
+    groups = data_metadata["groups"]
+    train_g = [groups[k] for k in train_list]
+    hold_g = [groups[k] for k in hold_out_list]
 
     # Ensure training groups were found before setting grouping
     if len(train_g) != 0:
@@ -230,29 +434,38 @@ def get_session_groupings(data_metadata, train_list, hold_out_list):
 
 def save_dict(filename, obj_to_save=None):
     """
-    Save dictionary to file.
+    Save dictionary to file. The file is written next to its destination first and then
+    moved into place, so an interrupted save never leaves a truncated file behind.
 
     Args:
     filename (str): path to file where dict is being saved.
     obj_to_save (dict): dict to save.
     """
 
-    # Parsing given file extension and saving model accordingly
-    if filename.endswith(".mat"):
-        print("Saving MAT file", filename)
-        scipy.io.savemat(filename, mdict=obj_to_save)
-    elif filename.endswith(".z"):
-        print("Saving compressed pickle", filename)
-        joblib.dump(obj_to_save, filename, compress=("zlib", 4))
-    elif filename.endswith((".pkl", ".p")):
-        print("Saving pickle", filename)
-        joblib.dump(obj_to_save, filename, compress=0)
-    elif filename.endswith(".h5"):
-        print("Saving h5 file", filename)
-        with h5py.File(filename, "w") as f:
-            dict_to_h5(f, obj_to_save)
-    else:
-        raise ValueError("Did not understand filetype")
+    tmp_file = filename + ".tmp"
+
+    try:
+        # Parsing given file extension and saving model accordingly
+        if filename.endswith(".mat"):
+            print("Saving MAT file", filename)
+            # appendmat=False, or savemat would write to tmp_file + ".mat"
+            scipy.io.savemat(tmp_file, mdict=obj_to_save, appendmat=False)
+        elif filename.endswith(".z"):
+            print("Saving compressed pickle", filename)
+            joblib.dump(obj_to_save, tmp_file, compress=("zlib", 4))
+        elif filename.endswith((".pkl", ".p")):
+            print("Saving pickle", filename)
+            joblib.dump(obj_to_save, tmp_file, compress=0)
+        elif filename.endswith(".h5"):
+            print("Saving h5 file", filename)
+            with h5py.File(tmp_file, "w") as f:
+                dict_to_h5(f, obj_to_save)
+        else:
+            raise ValueError("Did not understand filetype")
+        os.replace(tmp_file, filename)
+    finally:
+        if exists(tmp_file):
+            os.remove(tmp_file)
 
 
 def load_dict(filename):
@@ -294,13 +507,18 @@ def dict_to_h5(h5file, export_dict, path="/"):
 
         # Write dict item to h5 based on its data-type
         if isinstance(item, np.ndarray) and item.dtype == np.object:
-            dt = h5py.special_dtype(vlen=np.array(item.flat[0]).dtype)
-            h5file.create_dataset(path + key, item.shape, dtype=dt, compression="gzip")
-            for tup, _ in np.ndenumerate(item):
-                if item[tup] is not None:
-                    h5file[path + key][tup] = np.array(item[tup]).ravel()
+            base_dt = np.array(item.flat[0]).dtype
+            dt = h5py.special_dtype(vlen=base_dt)
+            dset = h5file.create_dataset(
+                path + key, item.shape, dtype=dt, **_H5_COMPRESSION
+            )
+            # fill the vlen cells in memory, then write them all in one call
+            cells = np.empty(item.shape, dtype=object)
+            for tup, v in np.ndenumerate(item):
+                cells[tup] = np.array([] if v is None else v, dtype=base_dt).ravel()
+            dset[...] = cells
         elif isinstance(item, (np.ndarray, list)):
-            h5file.create_dataset(path + key, data=item, compression="gzip")
+            h5file.create_dataset(path + key, data=item, **_H5_ARRAY_COMPRESSION)
         elif isinstance(item, (np.int, np.float, str, bytes)):
             h5file.create_dataset(path + key, data=item)
         elif isinstance(item, dict):
@@ -321,13 +539,15 @@ def load_arhmm_checkpoint(filename: str, train_data: dict) -> dict:
     mdl_dict (dict): a dict containing the model with reloaded data, and associated training data
     """
 
+    from autoregressive.util import AR_striding
+
     # Loading model and its respective number of lags
     mdl_dict = joblib.load(filename)
     nlags = mdl_dict["model"].nlags
 
     for s, t in zip(mdl_dict["model"].states_list, train_data.values()):
-        # Loading model AR-strided data
-        s.data = AR_striding(t.astype("float32"), nlags)
+        # Loading model AR-strided data; float32 sessions are strided without a copy
+        s.data = AR_striding(t.astype(np.float32, copy=False), nlags)
 
     return mdl_dict
 
@@ -341,13 +561,10 @@ def save_arhmm_checkpoint(filename: str, arhmm: dict):
     arhmm (dict): a dictionary containing the arhmm object, training iteration number, log-likelihoods of each training step, and labels for each step.
     """
 
-    # Getting model object
-    mdl = arhmm.pop("model")
-    arhmm["model"] = copy_model(mdl)
-
-    # Save model
+    # Save model without its training data; no need to copy it first
     print(f"Saving Checkpoint {filename}")
-    joblib.dump(arhmm, filename, compress=("zlib", 5))
+    with detached_data(arhmm["model"]):
+        joblib.dump(arhmm, filename, compress=_CHECKPOINT_COMPRESSION)
 
 
 def _load_h5_to_dict(file: h5py.File, path: str) -> dict:
@@ -362,17 +579,33 @@ def _load_h5_to_dict(file: h5py.File, path: str) -> dict:
     (dict): dict containing all of the h5 file contents.
     """
 
-    ans = {}
-    if isinstance(file[path], h5py._hl.dataset.Dataset):
+    # resolve the path once instead of on every access
+    node = file[path]
+    if isinstance(node, h5py.Dataset):
         # only use the final path key to add to `ans`
-        ans[path.split("/")[-1]] = file[path][()]
-    else:
-        # Reading in h5 value into dict key-value pair
-        for key, item in file[path].items():
-            if isinstance(item, h5py.Dataset):
-                ans[key] = item[()]
-            elif isinstance(item, h5py.Group):
-                ans[key] = _load_h5_to_dict(file, "/".join([path, key]))
+        return {path.split("/")[-1]: node[()]}
+    return _h5_group_to_dict(node)
+
+
+def _h5_group_to_dict(group: h5py.Group) -> dict:
+    """
+    Recursively load the contents of an h5 group into a dictionary.
+
+    Args:
+    group (h5py.Group): opened h5 group.
+
+    Returns:
+    (dict): dict containing all of the group contents.
+    """
+
+    ans = {}
+    # Reading in h5 value into dict key-value pair
+    for key, item in group.items():
+        if isinstance(item, h5py.Dataset):
+            ans[key] = item[()]
+        elif isinstance(item, h5py.Group):
+            # recurse on the group object itself, not on a re-resolved path
+            ans[key] = _h5_group_to_dict(item)
     return ans
 
 
@@ -417,11 +650,11 @@ def load_data_from_matlab(filename, var_name="features", npcs=10):
     with h5py.File(filename, "r") as f:
         # Loading PCs scores into training data dict
         if var_name in f:
-            score_tmp = f[var_name]
-            for i in range(len(score_tmp)):
-                tmp = f[score_tmp[i][0]]
-                score_to_add = tmp[()]
-                data_dict[i] = score_to_add[:npcs, :].T
+            # read all the session references at once
+            refs = f[var_name][()]
+            for i, ref in enumerate(refs[:, 0]):
+                # only read the requested PCs from the file
+                data_dict[i] = f[ref][:npcs].T
 
     return data_dict
 
@@ -442,21 +675,70 @@ def load_cell_string_from_matlab(filename, var_name="uuids"):
     with h5py.File(filename, "r") as f:
 
         if var_name in f:
-            tmp = f[var_name]
+            # read all the cell references at once
+            refs = f[var_name][()]
 
             # change unichr to chr for python 3
-            for i in range(len(tmp)):
-                tmp2 = f[tmp[i][0]]
-                uni_list = ["".join(chr(c)) for c in tmp2]
-                return_list.append("".join(uni_list))
+            for ref in refs[:, 0]:
+                # read each string's character codes in one go
+                codes = f[ref][()].ravel()
+                return_list.append("".join(map(chr, codes.tolist())))
 
     return return_list
 
 
+@contextmanager
+def detached_data(model_obj):
+    """
+    Temporarily remove the training data from the ARHMM, e.g. to serialize the model without it.
+
+    Args:
+    model_obj (ARHMM): model to remove the data from.
+    """
+
+    tmp = []
+    for s in model_obj.states_list:
+        tmp.append(s.data)
+        s.data = None
+
+    try:
+        yield model_obj
+    finally:
+        # now put the data back in the model for training
+        for s, t in zip(model_obj.states_list, tmp):
+            s.data = t
+
+
+class _DatalessPickler(pickle.Pickler):
+    """
+    Pickler that leaves the training data of the model's states out of the pickle.
+    """
+
+    def __init__(self, file, model_obj):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._data_ids = {
+            id(s.data) for s in model_obj.states_list if s.data is not None
+        }
+
+    def persistent_id(self, obj):
+        # the data arrays are stored as references and loaded back as None
+        return "data" if id(obj) in self._data_ids else None
+
+
+class _DatalessUnpickler(pickle.Unpickler):
+    """
+    Unpickler for models pickled with _DatalessPickler.
+    """
+
+    def persistent_load(self, pid):
+        return None
+
+
 # per Scott's suggestion
 def copy_model(model_obj):
     """
     Return a deep copy of the ARHMM that doesn't contain the training data.
+    The original model isn't modified, so it can be copied while it's in use elsewhere.
 
     Args:
     model_obj (ARHMM): model to copy.
@@ -465,21 +747,40 @@ def copy_model(model_obj):
     cp (ARHMM): copy of the model
     """
 
-    tmp = []
+    # copy through a pickle round-trip that skips the states' data; arrays are copied
+    # in C rather than object by object like deepcopy does
+    return load_model_snapshot(snapshot_model(model_obj))
 
-    # make a deep copy of the data-less version
-    for s in model_obj.states_list:
-        tmp.append(s.data)
-        s.data = None
 
-    cp = deepcopy(model_obj)
+def snapshot_model(model_obj):
+    """
+    Serialize the ARHMM without its training data, e.g. to save it later from another thread.
+    The snapshot only holds the pickled bytes, not a second live copy of the model.
+
+    Args:
+    model_obj (ARHMM): model to snapshot.
+
+    Returns:
+    snapshot (bytes): pickled model without the states' data.
+    """
 
-    # now put the data back in the model for training
+    buf = io.BytesIO()
+    _DatalessPickler(buf, model_obj).dump(model_obj)
+    return buf.getvalue()
 
-    for s, t in zip(model_obj.states_list, tmp):
-        s.data = t
 
-    return cp
+def load_model_snapshot(snapshot):
+    """
+    Rebuild an ARHMM from a snapshot made with snapshot_model; the states' data is None.
+
+    Args:
+    snapshot (bytes): pickled model returned by snapshot_model.
+
+    Returns:
+    model (ARHMM): model rebuilt from the snapshot.
+    """
+
+    return _DatalessUnpickler(io.BytesIO(snapshot)).load()
 
 
 def get_parameters_from_model(model):
@@ -526,7 +827,7 @@ def get_parameters_from_model(model):
     return parameters
 
 
-def count_frames(data_dict=None, input_file=None, var_name="scores"):
+def count_frames(data_dict=None, input_file=None, var_name="scores", check_nans=False):
     """
     Count the total number of frames loaded from the PC scores file.
 
@@ -534,6 +835,7 @@ def count_frames(data_dict=None, input_file=None, var_name="scores"):
     data_dict (OrderedDict): Loaded PC scores OrderedDict object.
     input_file (str): Path to PC Scores file to load data_dict if not already data_dict is None
     var_name (str): Path within PCA h5 file to load scores from.
+    check_nans (bool): check every PC for NaNs, in case some frames are only partially NaN.
 
     Returns:
     total_frames (int): total number of counted frames.
@@ -544,11 +846,34 @@ def count_frames(data_dict=None, input_file=None, var_name="scores"):
             filename=input_file, var_name=var_name, load_groups=True
         )
 
+    total_frames = _count_valid_frames(data_dict, check_nans=check_nans)
+    print("The total number of frames:", total_frames)
+    return total_frames
+
+
+def _count_valid_frames(data_dict, check_nans=False):
+    """
+    Count the frames that contain no NaN values across all sessions.
+
+    Args:
+    data_dict (OrderedDict): Loaded PC scores OrderedDict object.
+    check_nans (bool): check every PC for NaNs instead of assuming dropped frames are NaN
+     across all PCs.
+
+    Returns:
+    total_frames (int): total number of frames without NaNs.
+    """
+
     total_frames = 0
     for v in data_dict.values():
-        idx = (~np.isnan(v)).all(axis=1)
-        total_frames += np.sum(idx)
-    print("The total number of frames:", total_frames)
+        # dropped frames are normally NaN across all PCs, so the first PC suffices
+        invalid = np.isnan(v[:, 0])
+        if check_nans:
+            all_invalid = np.isnan(v).any(axis=1)
+            if not np.array_equal(all_invalid, invalid):
+                # some frames are only partially NaN; count those as invalid too
+                invalid = all_invalid
+        total_frames += len(v) - int(np.count_nonzero(invalid))
     return total_frames
 
 
@@ -564,28 +889,34 @@ def get_parameter_strings(config_data):
     prefix (str): Prefix string for the learn-model command (Slurm only).
     """
 
-    parameters = f' --npcs {config_data["npcs"]} --num-iter {config_data["num_iter"]} '
+    # collect the flags and join them once
+    params = [f'--npcs {config_data["npcs"]}', f'--num-iter {config_data["num_iter"]}']
 
     if isinstance(config_data["index"], str):
         if exists(config_data["index"]):
-            parameters += f'-i {config_data["index"]} '
+            params.append(f'-i {config_data["index"]}')
 
     if config_data["separate_trans"]:
-        parameters += "--separate-trans "
+        params.append("--separate-trans")
 
     if config_data["robust"]:
-        parameters += "--robust "
+        params.append("--robust")
 
     if config_data["e_step"]:
-        parameters += "--e-step "
+        params.append("--e-step")
 
     if config_data["hold_out"]:
-        parameters += f'--hold-out --nfolds {config_data["nfolds"]} '
+        params.append(f'--hold-out --nfolds {config_data["nfolds"]}')
 
     if config_data["max_states"]:
-        parameters += f'--max-states {config_data["max_states"]} '
+        params.append(f'--max-states {config_data["max_states"]}')
     if config_data["ncpus"] > 0:
-        parameters += f'--ncpus {config_data["ncpus"]} '
+        params.append(f'--ncpus {config_data["ncpus"]}')
+
+    if config_data.get("dtype", "float64") != "float64":
+        params.append(f'--dtype {config_data["dtype"]}')
+
+    parameters = " " + " ".join(params) + " "
 
     # Handle possible Slurm batch functionality
     prefix = ""
@@ -617,28 +948,22 @@ def create_command_strings(
     base_command = f"moseq2-model learn-model {input_file} "
     parameters, prefix = get_parameter_strings(config_data)
 
-    commands = []
-    for i, k in enumerate(kappas):
-        # Create CLI command
-        cmd = (
-            base_command
-            + join(output_dir, model_name_format.format(i, k))
-            + parameters
-            + f"--kappa {k}"
-        )
+    # Close the quoted command of the batch fitting prefix (empty without Slurm)
+    suffix = '"' if config_data["cluster_type"] == "slurm" else ""
 
-        # Add possible batch fitting prefix string
-        if config_data["cluster_type"] == "slurm":
-            cmd = prefix + cmd + '"'
-        commands.append(cmd)
+    # Create CLI commands; only the model path and kappa change between them
+    commands = [
+        f"{prefix}{base_command}{join(output_dir, model_name_format.format(i, k))}"
+        f"{parameters}--kappa {k}{suffix}"
+        for i, k in enumerate(kappas)
+    ]
 
     # Create and return the command string
-    command_string = "\n".join(commands)
-    command_string = "set -e\n" + command_string
+    command_string = "\n".join(["set -e"] + commands)
     return command_string
 
 
-def get_scan_range_kappas(data_dict, config_data):
+def get_scan_range_kappas(data_dict, config_data, nframes=None):
     """
     Get the kappa values to train models on based on the user's selected scanning scale range.
     Default values will be selected if min/max_kappa are None.
@@ -659,12 +984,14 @@ def get_scan_range_kappas(data_dict, config_data):
     Args:
     data_dict (OrderedDict): Loaded PCA score dictionary.
     config_data (dict): Configuration parameters dict.
+    nframes (int): number of valid frames, if already known; counted from data_dict otherwise.
 
     Returns:
     kappas (list): list of ints corresponding to the kappa value for each model.
     """
 
-    nframes = count_frames(data_dict)
+    if nframes is None:
+        nframes = count_frames(data_dict)
 
     if config_data.get("scan_scale", "log") == "log":
         # Get log scan range
@@ -76,5 +76,7 @@ setup(
         "pybasicbayes @ git+https://github.com/mattjj/pybasicbayes.git@master",
         "autoregressive @ git+https://github.com/dattalab/pyhsmm-autoregressive.git@master",
     ],
+    # faster checkpoint compression; checkpoints fall back to zlib without it
+    extras_require={"lz4": ["lz4==3.1.0"]},
     entry_points={"console_scripts": ["moseq2-model = moseq2_model.cli:cli"]},
 )
@@ -1,8 +1,12 @@
 import os
+import shlex
 import shutil
-from unittest import TestCase
+from os.path import join
+from unittest import TestCase, mock
+from concurrent.futures import ThreadPoolExecutor
 from click.testing import CliRunner
 from moseq2_model.cli import learn_model, count_frames, kappa_scan_fit_models
+from moseq2_model.helpers.wrappers import fit_kappa_scan_models
 
 
 class TestCLI(TestCase):
@@ -107,3 +111,87 @@ class TestCLI(TestCase):
         assert result.exit_code == 0, "CLI Command did not successfully complete"
         assert os.path.exists("./data/models/train_out.sh")
         shutil.rmtree("./data/models/")
+
+    def test_kappa_scan_run_local(self):
+        input_file = "data/_pca/pca_scores.h5"
+        dest_dir = "data/models/"
+        pool_sizes = []
+
+        class RecordingExecutor(ThreadPoolExecutor):
+            # threads instead of processes, so the stubbed wrapper records the calls
+            def __init__(self, max_workers=None):
+                pool_sizes.append(max_workers)
+                super().__init__(max_workers=max_workers)
+
+        kappa_scan_params = [
+            input_file,
+            dest_dir,
+            "-n",
+            5,
+            "--n-models",
+            2,
+            "--min-kappa",
+            1e4,
+            "--max-kappa",
+            1e5,
+            "--run-cmd",
+            "--max-workers",
+        ]
+
+        scan_only = ("out_script", "get_cmd", "run_cmd", "min_kappa", "max_workers")
+
+        runner = CliRunner()
+        # one model at a time unless --max-workers asks for more
+        for max_workers, expected_pool in ((None, 1), (1, 1), (3, 2)):
+            pool_sizes.clear()
+            if max_workers is None:
+                params = kappa_scan_params[:-1]
+            else:
+                params = kappa_scan_params + [max_workers]
+            with mock.patch(
+                "moseq2_model.helpers.wrappers.ProcessPoolExecutor", RecordingExecutor
+            ), mock.patch(
+                "moseq2_model.helpers.wrappers.learn_model_wrapper"
+            ) as wrapper:
+                result = runner.invoke(
+                    kappa_scan_fit_models,
+                    params,
+                    catch_exceptions=False,
+                )
+
+            assert result.exit_code == 0, "CLI Command did not successfully complete"
+            # the pool never has more workers than models
+            assert pool_sizes == [expected_pool]
+            assert wrapper.call_count == 2
+
+            # each model is fit with the parameters of its command in the saved script
+            with open(join(dest_dir, "train_out.sh")) as f:
+                script_configs = {}
+                for cmd in f.read().splitlines()[1:]:
+                    params = learn_model.make_context(
+                        "learn-model", shlex.split(cmd)[2:]
+                    ).params
+                    script_configs[params.pop("dest_file")] = params
+
+            configs = [call[0][2] for call in wrapper.call_args_list]
+            assert sorted(c["kappa"] for c in configs) == [10000, 100000]
+            for call in wrapper.call_args_list:
+                pc_file, dest_file, config = call[0]
+                assert {"input_file": pc_file, **config} == script_configs[dest_file]
+
+            for config in configs:
+                assert config["num_iter"] == 5
+                # scan-only options aren't recorded in the models' run_parameters
+                for key in scan_only:
+                    assert key not in config
+
+        # nothing to fit, and no pool is started
+        pool_sizes.clear()
+        with mock.patch(
+            "moseq2_model.helpers.wrappers.ProcessPoolExecutor", RecordingExecutor
+        ), mock.patch("moseq2_model.helpers.wrappers.learn_model_wrapper") as wrapper:
+            fit_kappa_scan_models(input_file, dest_dir, {"ncpus": 1}, [])
+        assert pool_sizes == []
+        assert wrapper.call_count == 0
+
+        shutil.rmtree("./data/models/")
@@ -1,9 +1,12 @@
 import os
 import sys
+import random
+import numpy as np
 import ruamel.yaml as yaml
 from os.path import dirname
 from unittest import TestCase
-from moseq2_model.util import load_pcs
+from collections import OrderedDict
+from moseq2_model.util import load_pcs, count_frames
 from moseq2_model.helpers.data import (
     process_indexfile,
     select_data_to_model,
@@ -11,6 +14,7 @@ from moseq2_model.helpers.data import (
     get_heldout_data_splits,
     get_training_data_splits,
     graph_modeling_loglikelihoods,
+    _add_white_noise,
 )
 
 
@@ -94,6 +98,12 @@ class TestDataHelpers(TestCase):
             index_data, data_dict, data_metadata
         )
 
+        # kappa defaults to the number of valid frames
+        config_data["kappa"] = None
+        nframes = count_frames(data_dict)
+        # the input scores must come out of every call untouched
+        originals = {k: (v, v.copy()) for k, v in data_dict.items()}
+
         (
             data_dict1,
             model_parameters,
@@ -102,6 +112,7 @@ class TestDataHelpers(TestCase):
             whitening_parameters,
         ) = prepare_model_metadata(data_dict, data_metadata, config_data)
 
+        assert model_parameters["kappa"] == nframes, "kappa was not set to nframes"
         assert (
             data_dict.values() != data_dict1.values()
         ), "Index loaded uuids and training data does not match scores file"
@@ -109,6 +120,10 @@ class TestDataHelpers(TestCase):
             data_dict1
         ), "Loaded uuids do not match total number of uuids"
         assert hold_out_list == [], "Some of the data is unintentionally held out"
+        for k, (v, v_copy) in originals.items():
+            assert data_dict[k] is v, "input data_dict entries were replaced"
+            # NaN frames compare equal here
+            np.testing.assert_array_equal(v, v_copy, "input scores were modified")
 
         config_data["whiten"] = "each"
         config_data["noise_level"] = 1
@@ -127,6 +142,10 @@ class TestDataHelpers(TestCase):
             data_dict1
         ), "Loaded uuids do not match total number of uuids"
         assert hold_out_list == [], "Some of the data is unintentionally held out"
+        for k, (v, v_copy) in originals.items():
+            assert data_dict[k] is v, "input data_dict entries were replaced"
+            # NaN frames compare equal here
+            np.testing.assert_array_equal(v, v_copy, "input scores were modified")
 
         config_data["whiten"] = "none"
         (
@@ -144,6 +163,41 @@ class TestDataHelpers(TestCase):
             data_dict1
         ), "Loaded uuids do not match total number of uuids"
         assert hold_out_list == [], "Some of the data is unintentionally held out"
+        for k, (v, v_copy) in originals.items():
+            assert data_dict[k] is v, "input data_dict entries were replaced"
+            # NaN frames compare equal here
+            np.testing.assert_array_equal(v, v_copy, "input scores were modified")
+
+        # the scores are cast to the training precision, with and without whitening
+        for whiten in ("all", "each", "none"):
+            config_data["whiten"] = whiten
+            config_data["dtype"] = "float32"
+            data_dict1, *_ = prepare_model_metadata(
+                data_dict, data_metadata, config_data
+            )
+            assert all(v.dtype == np.float32 for v in data_dict1.values())
+        config_data["dtype"] = "float64"
+        config_data["whiten"] = "none"
+
+        # the same seeded generator adds the same noise
+        noisy = [
+            prepare_model_metadata(
+                data_dict, data_metadata, config_data, rng=np.random.default_rng(0)
+            )[0]
+            for _ in range(2)
+        ]
+        for v1, v2 in zip(noisy[0].values(), noisy[1].values()):
+            np.testing.assert_array_equal(v1, v2)
+
+    def test_add_white_noise(self):
+        rng = np.random.default_rng(0)
+        assert _add_white_noise(OrderedDict(), 1, rng) == OrderedDict()
+
+        scores = np.zeros((10, 3), dtype=np.float32)
+        noisy = _add_white_noise(OrderedDict(a=scores), 1, rng)
+        assert noisy["a"].shape == scores.shape
+        assert noisy["a"].dtype == np.float32
+        assert np.all(scores == 0), "noise was added in place"
 
     def test_get_heldout_data_splits(self):
         input_file = "data/_pca/pca_scores.h5"
@@ -186,6 +240,16 @@ class TestDataHelpers(TestCase):
             train_data is not None and test_data is not None
         ), "There are missing datasets"
 
+        # a hold_out_seed selects the same sessions as random.Random(seed).sample
+        config_data["hold_out_seed"] = 42
+        _, _, train_list, hold_out_list, _ = prepare_model_metadata(
+            data_dict, data_metadata, config_data
+        )
+        expected = random.Random(42).sample(list(data_dict), len(data_dict))
+        splits = np.array_split(expected, config_data["nfolds"])
+        assert hold_out_list == list(splits[0]), "Seeded hold out sessions changed"
+        assert train_list == list(np.concatenate(splits[1:]))
+
     def test_get_training_data_splits(self):
 
         input_file = "data/_pca/pca_scores.h5"
@@ -220,6 +284,14 @@ class TestDataHelpers(TestCase):
             percent_out == config_data["percent_split"]
         ), "Config file was not correctly updated"
 
+        # split_frac is the fraction from the start used for training
+        training_data, validation_data = get_training_data_splits(0.3, data_dict)
+        for k, v in data_dict.items():
+            n = int(len(v) * 0.3)
+            assert len(training_data[k]) == n, "Training split is incorrect"
+            np.testing.assert_array_equal(training_data[k], v[:n])
+            np.testing.assert_array_equal(validation_data[k], v[-n:])
+
     def test_graph_modeling_loglikelihoods(self):
         dest_file = "data/_pca/pca_scores.h5"
         config_file = "data/config.yaml"
@@ -239,6 +311,11 @@ class TestDataHelpers(TestCase):
         assert os.path.exists(img_path), "Something went wrong; graph was not created."
         os.remove(img_path)
 
+        # the figure is closed once it's saved
+        import matplotlib.pyplot as plt
+
+        assert plt.get_fignums() == [], "The summary figure was left open"
+
         iter_lls = [[12, 15, 19], [15, 16, 18]]
         iter_holls = [[2, 3, 8], [5, 5, 9]]
 
@@ -1,14 +1,18 @@
 import numpy as np
 from scipy import stats
 from copy import deepcopy
+from os.path import basename, join
+from tempfile import TemporaryDirectory
 import ruamel.yaml as yaml
 from unittest import TestCase
-from moseq2_model.util import load_pcs
+from moseq2_model.util import load_pcs, find_checkpoints, load_arhmm_checkpoint
 from moseq2_model.train.models import ARHMM
 from moseq2_model.helpers.data import prepare_model_metadata, get_training_data_splits
 from moseq2_model.train.util import (
     train_model,
     get_labels_from_model,
+    label_dtype,
+    pad_labels,
     whiten_all,
     whiten_each,
     run_e_step,
@@ -111,6 +115,42 @@ class TestTrainUtils(TestCase):
         assert len(iter_lls) == 5
         assert len(iter_holls) == 5
 
+    def test_train_model_checkpoint_resume(self):
+        model, data_dict = get_model()
+
+        with TemporaryDirectory() as tmp:
+            # checkpoints are written by the background checkpoint thread
+            model, lls, labels, iter_lls, iter_holls, _ = train_model(
+                model,
+                num_iter=4,
+                checkpoint_freq=2,
+                checkpoint_file=join(tmp, "model"),
+            )
+
+            all_checkpoints = find_checkpoints(tmp, "model")
+            assert [basename(c) for c in all_checkpoints] == [
+                "model-checkpoint_1.arhmm",
+                "model-checkpoint_3.arhmm",
+            ]
+
+            checkpoint = load_arhmm_checkpoint(all_checkpoints[-1], data_dict)
+            assert checkpoint["iter"] == 4
+            for l1, l2 in zip(checkpoint["labels"], labels):
+                np.testing.assert_array_equal(l1, l2)
+
+            # the snapshot matches the last iteration, and its data is reloaded
+            resumed = checkpoint["model"]
+            for s1, s2 in zip(resumed.states_list, model.states_list):
+                np.testing.assert_array_equal(s1.stateseq, s2.stateseq)
+                assert s1.data is not None
+
+            resumed, lls, labels, iter_lls, iter_holls, _ = train_model(
+                resumed, num_iter=6, start=checkpoint["iter"]
+            )
+            assert isinstance(resumed, FastARWeakLimitStickyHDPHMM)
+            assert len(labels) == 2
+            assert len(labels[0]) == 906
+
     def test_get_labels_from_model(self):
 
         config_file = "data/config.yaml"
@@ -132,6 +172,28 @@ class TestTrainUtils(TestCase):
         labels = get_labels_from_model(model)
         print(labels)
         assert len(labels[0]) == 906
+        # labels are saved as int16 for up to 32767 states
+        assert all(l.dtype == np.int16 for l in labels)
+
+    def test_label_dtype(self):
+        assert label_dtype(2) == np.int16
+        assert label_dtype(100) == np.int16
+        assert label_dtype(32768) == np.int16
+        assert label_dtype(40000) == np.int32
+
+    def test_pad_labels(self):
+        labels = np.array([3, 0, 7, 7], dtype=np.int32)
+
+        for nlags, dtype in ((3, np.int16), (1, np.int32), (0, np.int16)):
+            padded = pad_labels(labels, nlags, dtype)
+            assert padded.dtype == dtype
+            assert len(padded) == len(labels) + nlags
+            assert np.all(padded[:nlags] == -5)
+            assert np.array_equal(padded[nlags:], labels)
+
+        # the labels aren't changed
+        assert labels.dtype == np.int32
+        assert np.array_equal(labels, [3, 0, 7, 7])
 
     def test_whiten_all(self):
 
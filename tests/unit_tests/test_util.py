@@ -1,9 +1,14 @@
 import os
 import sys
+import time
 import h5py
 import numpy as np
+import scipy.io
 import ruamel.yaml as yaml
 from unittest import TestCase
+from os.path import basename, join
+from tempfile import TemporaryDirectory
+from collections import OrderedDict
 from tests.unit_tests.test_train_utils import get_model
 from moseq2_model.train.util import whiten_all, train_model
 from moseq2_model.helpers.data import get_training_data_splits
@@ -12,15 +17,20 @@ from moseq2_model.util import (
     load_cell_string_from_matlab,
     load_pcs,
     save_dict,
+    load_dict,
     dict_to_h5,
     h5_to_dict,
     _load_h5_to_dict,
+    _read_h5_sessions,
     copy_model,
     get_parameters_from_model,
     count_frames,
     get_parameter_strings,
     create_command_strings,
     get_scan_range_kappas,
+    get_loglikelihoods,
+    get_loglikelihoods_pair,
+    find_checkpoints,
 )
 
 
@@ -36,6 +46,18 @@ class TestUtils(TestCase):
 
         assert nframes == 1800
 
+        # counting from the file, or from the single PC the kappa scan loads, agrees
+        assert count_frames(input_file=input_data, var_name="scores") == nframes
+        data_dict, _ = load_pcs(input_data, var_name="scores", npcs=1, load_groups=True)
+        assert count_frames(data_dict) == nframes
+
+        # partially NaN frames are only caught with check_nans
+        scores = np.ones((10, 3))
+        scores[0] = np.nan
+        scores[1, 2] = np.nan
+        assert count_frames({"a": scores}) == 9
+        assert count_frames({"a": scores}, check_nans=True) == 8
+
     def test_get_parameter_strings(self):
 
         index = "data/test_index.yaml"
@@ -67,6 +89,15 @@ class TestUtils(TestCase):
         assert parameters == truth_str
         assert prefix == truth_prefix
 
+        # the training precision is only passed on when it isn't the default
+        config_data["dtype"] = "float64"
+        parameters, prefix = get_parameter_strings(config_data)
+        assert parameters == truth_str
+
+        config_data["dtype"] = "float32"
+        parameters, prefix = get_parameter_strings(config_data)
+        assert parameters == truth_str + "--dtype float32 "
+
     def test_create_command_strings(self):
         input_file = "data/_pca/pca_scores.h5"
         index_file = "data/test_index.yaml"
@@ -239,35 +270,75 @@ class TestUtils(TestCase):
         assert list(data_dict.keys()) == data_metadata["uuids"]
         os.remove(outfile)
 
+    def test_read_h5_sessions(self):
+        input_data = "data/_pca/pca_scores.h5"
+        with h5py.File(input_data, "r") as f:
+            group = f["scores"]
+            width = next(iter(group.values())).shape[1]
+            # fewer PCs than stored, all of them, and more than stored
+            for npcs in (1, 5, width, width + 10):
+                data_dict = _read_h5_sessions(group, npcs)
+                assert list(data_dict) == list(group)
+                for k in group:
+                    np.testing.assert_array_equal(data_dict[k], group[k][()][:, :npcs])
+
+        # sessions with different dtypes or widths, and empty sessions
+        with TemporaryDirectory() as tmp:
+            with h5py.File(join(tmp, "scores.h5"), "w") as f:
+                f.create_dataset("a", data=np.random.randn(20, 6))
+                f.create_dataset("b", data=np.zeros((0, 6)))
+                f.create_dataset("c", data=np.random.randn(15, 6))
+                for npcs in (3, 6):
+                    data_dict = _read_h5_sessions(f, npcs)
+                    for k in f:
+                        np.testing.assert_array_equal(data_dict[k], f[k][()][:, :npcs])
+
+                f.create_dataset("d", data=np.random.randn(10, 4).astype(np.float32))
+                data_dict = _read_h5_sessions(f, 5)
+                for k in f:
+                    np.testing.assert_array_equal(data_dict[k], f[k][()][:, :5])
+                    assert data_dict[k].dtype == f[k].dtype
+
     def test_save_dict(self):
         input_data = "data/_pca/pca_scores.h5"
         data_dict, data_metadata = load_pcs(
             input_data, var_name="scores", load_groups=True
         )
+        # string keys and plain arrays round-trip through every format
+        to_save = {f"session{i}": v for i, v in enumerate(data_dict.values())}
 
-        outfile = "data/saved_dict.pkl"
-        save_dict(outfile, data_dict)
+        for ext in (".pkl", ".p", ".z", ".h5"):
+            outfile = "data/saved_dict" + ext
+            save_dict(outfile, to_save)
 
-        assert os.path.exists(outfile)
-        os.remove(outfile)
-
-        outfile = "data/saved_dict.h5"
-        save_dict(outfile, data_dict)
-
-        assert os.path.exists(outfile)
-        os.remove(outfile)
+            assert os.path.exists(outfile)
+            assert not os.path.exists(outfile + ".tmp")
+            loaded = load_dict(outfile)
+            assert set(loaded) == set(to_save)
+            for k, v in to_save.items():
+                np.testing.assert_array_equal(loaded[k], v)
+            os.remove(outfile)
 
-        outfile = "data/saved_dict.z"
-        save_dict(outfile, data_dict)
+        outfile = "data/saved_dict.mat"
+        save_dict(outfile, to_save)
 
         assert os.path.exists(outfile)
+        assert not os.path.exists(outfile + ".tmp")
+        loaded = scipy.io.loadmat(outfile)
+        for k, v in to_save.items():
+            np.testing.assert_array_equal(loaded[k], v)
         os.remove(outfile)
 
-        outfile = "data/saved_dict.mat"
-        save_dict(outfile, data_dict)
+        # a failed save leaves neither the destination nor the temporary file
+        outfile = "data/saved_dict.h5"
+        self.assertRaises(ValueError, save_dict, outfile, {"tup": (1, 2, 3)})
+        assert not os.path.exists(outfile)
+        assert not os.path.exists(outfile + ".tmp")
 
-        assert os.path.exists(outfile)
-        os.remove(outfile)
+        outfile = "data/saved_dict.txt"
+        self.assertRaises(ValueError, save_dict, outfile, to_save)
+        assert not os.path.exists(outfile)
+        assert not os.path.exists(outfile + ".tmp")
 
     def test_h5_to_dict(self):
         input_data = "data/_pca/pca_scores.h5"
@@ -333,9 +404,79 @@ class TestUtils(TestCase):
             model, num_iter=5, train_data=training_data, val_data=validation_data
         )
 
+        data = [s.data for s in model.states_list]
         cp = copy_model(model)
         assert sys.getsizeof(model) == sys.getsizeof(cp)
 
+        # the copy has no training data, and the original keeps the same data objects
+        assert cp is not model
+        assert len(cp.states_list) == len(model.states_list)
+        assert all(s.data is None for s in cp.states_list)
+        assert all(s.data is d for s, d in zip(model.states_list, data))
+        assert all(d is not None for d in data)
+        for s1, s2 in zip(cp.states_list, model.states_list):
+            assert s1.stateseq is not s2.stateseq
+            np.testing.assert_array_equal(s1.stateseq, s2.stateseq)
+
+    def test_get_loglikelihoods_pair(self):
+        model, data_dict = get_model()
+        X, whitening_parameters = whiten_all(data_dict)
+
+        # more than 4 sessions, so ncpus > 1 takes the parallel path
+        train_data = OrderedDict((f"{k}-{i}", v) for i in range(3) for k, v in X.items())
+        test_data = OrderedDict(list(X.items())[:1])
+
+        train_ll, test_ll = get_loglikelihoods_pair(
+            model, train_data, test_data, None, False, ncpus=1
+        )
+        assert len(train_ll) == len(train_data)
+        assert len(test_ll) == len(test_data)
+        assert np.allclose(
+            train_ll, get_loglikelihoods(model, train_data, None, False, ncpus=1)
+        )
+
+        par_train_ll, par_test_ll = get_loglikelihoods_pair(
+            model, train_data, test_data, None, False, ncpus=2
+        )
+        assert np.allclose(par_train_ll, train_ll)
+        assert np.allclose(par_test_ll, test_ll)
+
+        train_ll, test_ll = get_loglikelihoods_pair(
+            model, train_data, None, None, False, ncpus=2
+        )
+        assert np.allclose(train_ll, par_train_ll)
+        assert test_ll is None
+
+    def test_find_checkpoints(self):
+        with TemporaryDirectory() as tmp:
+            assert find_checkpoints(join(tmp, "missing"), "model") == []
+
+            # newer checkpoints sort last by creation time, not by name
+            names = [
+                "model-checkpoint_9.arhmm",
+                "model.z-checkpoint_10.arhmm",
+                "model-checkpoint_11.arhmm",
+                # other models and files in the directory are skipped
+                "model2-checkpoint_12.arhmm",
+                "model-checkpoint_13.p",
+            ]
+            for name in names:
+                with open(join(tmp, name), "w") as f:
+                    f.write("")
+                time.sleep(0.01)
+            os.mkdir(join(tmp, "model-checkpoint_14.arhmm"))
+
+            found = [basename(c) for c in find_checkpoints(tmp, "model")]
+            assert found == ["model-checkpoint_9.arhmm", "model-checkpoint_11.arhmm"]
+
+            # checkpoints saved under the older naming are found too
+            found = [basename(c) for c in find_checkpoints(tmp, "model", "model.z")]
+            assert found == [
+                "model-checkpoint_9.arhmm",
+                "model.z-checkpoint_10.arhmm",
+                "model-checkpoint_11.arhmm",
+            ]
+
     def test_get_parameters_from_model(self):
 
         def check_params(model, params):